@@ -67,7 +67,8 @@ DEFAULT_PARAMETERS = {'relative_area_threshold': 0.002,
                       'gaussian_blur': 5,
                       'extreme_meso': 0,
                       'running_avg': 0.4,
-                      'exponent': 9
+                      'exponent': 9,
+                      'dilation_iter': 10
                       }
 
 
@@ -297,10 +298,17 @@ class TrackedVideo(dj.Computed):
 
         key['tracking_parameters'] = json.dumps(param)
         self.insert1(key)
-        fr = self.Frame()
-        for trace in traces:
-            trace.update(key)
-            fr.insert1(trace, ignore_extra_fields=True)
+        frames = []
+        for i, frame_id in enumerate(traces['frame_id']):
+            # all rows need the same fields; NaN and None are inserted as NULL
+            frame = dict(key, frame_id=frame_id, frame_intensity=traces['frame_intensity'][i])
+            if traces['contour'][i] is not None:
+                frame.update(center=traces['center'][i], major_r=traces['major_r'][i],
+                             rotated_rect=traces['rotated_rect'][i], contour=traces['contour'][i])
+            else:
+                frame.update(center=None, major_r=None, rotated_rect=None, contour=None)
+            frames.append(frame)
+        self.Frame().insert(frames, ignore_extra_fields=True)
 
         self.notify(key)
 
@@ -1,8 +1,14 @@
-from collections import defaultdict
+import copy
+from functools import lru_cache
 from itertools import count
 from operator import attrgetter
 from os import path as op
+import queue
+import threading
+import time
+import multiprocessing as mp
 import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -15,6 +21,11 @@ try:
 except ImportError:
     print("Could not find cv2. You won't be able to use the pupil tracker.")
 
+try:
+    import av
+except ImportError:
+    av = None  # videos are decoded with cv2 instead
+
 ANALOG_PACKET_LEN = 2000
 
 
@@ -22,23 +33,26 @@ class CVROIGrabber:
     start = None
     end = None
     roi = None
+    _grid_cache = {}  # pixel coordinate grids shared between instances, by image shape
 
     def __init__(self, img):
         self.img = img
-        self.draw_img = np.asarray(img / img.max(), dtype=float)
+        self._norm_img = np.asarray(img / img.max(), dtype=np.float32)
+        self.draw_img = self._norm_img.copy()
         self.mask = 1 + 0 * img
         self.exit = False
         self.r = 40
-        self.X, self.Y = np.mgrid[:img.shape[0], :img.shape[1]]
+        if img.shape not in CVROIGrabber._grid_cache:
+            CVROIGrabber._grid_cache[img.shape] = np.mgrid[:img.shape[0], :img.shape[1]].astype(np.int32)
+        self.X, self.Y = CVROIGrabber._grid_cache[img.shape]
 
     def grab(self):
         print('Contrast (std)', np.std(self.img))
-        img = np.asarray(self.img / self.img.max(), dtype=float)
         cv2.namedWindow('real image')
         cv2.setMouseCallback('real image', self, 0)
 
         while not self.exit:
-            cv2.imshow('real image', img)
+            cv2.imshow('real image', self._norm_img)
             if (cv2.waitKey(0) & 0xFF) == ord('q'):
                 cv2.waitKey(1)
                 cv2.destroyAllWindows()
@@ -46,8 +60,6 @@ class CVROIGrabber:
         cv2.waitKey(2)
 
     def __call__(self, event, x, y, flags, params):
-        # img = np.asarray(self.img , dtype=np.uint8)[...,None] * np.ones((1,1,3), dtype=np.uint8)
-        img = np.asarray(self.img / self.img.max(), dtype=float)
         cv2.imshow('real image', self.draw_img)
 
         if event == cv2.EVENT_LBUTTONDOWN:
@@ -59,13 +71,13 @@ class CVROIGrabber:
             x = np.vstack((self.start, self.end))
             tmp = np.hstack((x.min(axis=0), x.max(axis=0)))
             roi = np.asarray([[tmp[1], tmp[3]], [tmp[0], tmp[2]]], dtype=int) + 1
-            crop = img[roi[0, 0]:roi[0, 1], roi[1, 0]:roi[1, 1]]
+            crop = self._norm_img[roi[0, 0]:roi[0, 1], roi[1, 0]:roi[1, 1]]
             crop = np.asarray(crop / crop.max(), dtype=float)
             self.roi = roi
             cv2.imshow('crop', crop)
 
             # m = (img * self.mask).copy() # needed for a weird reason
-            self.draw_img = (img * self.mask).copy()
+            self.draw_img = (self._norm_img * self.mask).copy()
             cv2.rectangle(self.draw_img, tuple(self.start), tuple(self.end), (0, 255, 0), 2)
 
             cv2.imshow('real image', self.draw_img)
@@ -77,8 +89,9 @@ class CVROIGrabber:
                 self.mask = 0 * self.mask + 1
 
         elif event == cv2.EVENT_MBUTTONDOWN:
-            self.mask[(self.X - y) ** 2 + (self.Y - x) ** 2 < self.r ** 2] = 0.
-            self.draw_img[(self.X - y) ** 2 + (self.Y - x) ** 2 < self.r ** 2] = 0.
+            brush = (self.X - y) ** 2 + (self.Y - x) ** 2 < self.r * self.r
+            self.mask[brush] = 0.
+            self.draw_img[brush] = 0.
             cv2.imshow('real image', self.draw_img)
 
             key = (cv2.waitKey(0) & 0xFF)
@@ -191,13 +204,9 @@ class ROISelector:
     def draw_rectangle(self, p1, p2, color='dodgerblue'):
         low_x, high_x = (p1.x, p2.x) if p1.x <= p2.x else (p2.x, p1.x)
         low_y, high_y = (p1.y, p2.y) if p1.y <= p2.y else (p2.y, p1.y)
-        plt.plot([low_x, low_x], [low_y, high_y], color=color, lw=2)
-        plt.plot([high_x, high_x], [low_y, high_y], color=color, lw=2)
-        plt.plot([low_x, high_x], [low_y, low_y], color=color, lw=2)
-        plt.plot([low_x, high_x], [high_y, high_y], color=color, lw=2)
-
-        plt.plot(p1.x, p1.y, 'ok', mfc='gold')
-        plt.plot(p2.x, p2.y, 'ok', mfc='deeppink')
+        plt.gca().add_patch(Rectangle((low_x, low_y), high_x - low_x, high_y - low_y, fill=False,
+                                      edgecolor=color, lw=2))
+        plt.scatter([p1.x, p2.x], [p1.y, p2.y], c=['gold', 'deeppink'], edgecolors='k', zorder=3)
 
 
 class PointLabeler:
@@ -299,6 +308,7 @@ class PupilTracker:
     contrast_threshold           : float        # contrast below that threshold are considered dark
     speed_threshold              : float        # eye center can at most move that fraction of the roi between frames
     dr_threshold                 : float        # maximally allow relative change in radius
+    dilation_iter                : int          # the search around the last detected ellipse extends that many pixels
 
     """
 
@@ -309,108 +319,112 @@ class PupilTracker:
         self._mask = mask
         self._last_detection = 1
         self._last_ellipse = None
+        self._mask_ellipse = None
+        self._tracking_mask = None
 
     @staticmethod
     def goodness_of_fit(contour, ellipse):
         center, size, angle = ellipse
         angle *= np.pi / 180
-        err = 0
-        for coord in contour.squeeze().astype(np.float):
-            posx = (coord[0] - center[0]) * np.cos(-angle) - (coord[1] - center[1]) * np.sin(-angle)
-            posy = (coord[0] - center[0]) * np.sin(-angle) + (coord[1] - center[1]) * np.cos(-angle)
-            err += ((posx / size[0]) ** 2 + (posy / size[1]) ** 2 - 0.25) ** 2
+        ca, sa = np.float32(np.cos(-angle)), np.float32(np.sin(-angle))
+        coords = contour.reshape(-1, 2).astype(np.float32)  # single precision is plenty for pixel residuals
+        dx = coords[:, 0] - center[0]
+        dy = coords[:, 1] - center[1]
+        posx = dx * ca - dy * sa
+        posy = dx * sa + dy * ca
+        err = ((posx / size[0]) ** 2 + (posy / size[1]) ** 2 - 0.25) ** 2
 
-        return np.sqrt(err / len(contour))
+        return np.sqrt(err.sum() / len(contour))
 
     @staticmethod
     def restrict_to_long_axis(contour, ellipse, corridor):
         center, size, angle = ellipse
         angle *= np.pi / 180
-        R = np.asarray([[np.cos(-angle), - np.sin(-angle)], [np.sin(-angle), np.cos(-angle)]])
-        contour = np.dot(contour.squeeze() - center, R.T)
-        contour = contour[np.abs(contour[:, 0]) < corridor * ellipse[1][1] / 2]
-        return (np.dot(contour, R) + center).astype(np.int32)
+        ca, sa = np.cos(-angle), np.sin(-angle)
+        contour = contour.reshape(-1, 2) - center
+        xr = contour[:, 0] * ca - contour[:, 1] * sa
+        keep = np.abs(xr) < corridor * size[1] / 2
+        return (contour[keep] + center).astype(np.int32)
 
-    def get_pupil_from_contours(self, contours, small_gray, mask, show_matching=5):
+    def score_ellipses(self, ellipses, errors, shape):
+        """ Evaluates the matching conditions for all candidate ellipses of a frame at once.
+
+        Returns two dicts with one array entry per quantity: the scores of each candidate and
+        whether each candidate satisfies the corresponding matching condition.
+        """
         ratio_thres = self._params['ratio_threshold']
         area_threshold = self._params['relative_area_threshold']
         error_threshold = self._params['error_threshold']
-        min_contour = self._params['min_contour_len']
         margin = self._params['margin']
         speed_thres = self._params['speed_threshold']
         dr_thres = self._params['dr_threshold']
+
+        centers = np.array([e[0] for e in ellipses]) / np.array(shape[::-1])
+        axes = np.array([e[1] for e in ellipses])
+        r = axes.max(axis=1)
+        ratio = r / axes.min(axis=1)
+        area = axes.prod(axis=1) / np.prod(shape)
+
+        dr = 0 * r if self._radius is None else np.abs(r - self._radius) / self._radius
+        dx = 0 * r if self._center is None else np.sqrt(np.sum((centers - self._center) ** 2, axis=1))
+
+        results = {'ratio': ratio, 'area': area, 'rmse': errors,
+                   'x coord': centers[:, 0], 'y coord': centers[:, 1], 'dx': dx, 'dr/r': dr}
+        cond = {'ratio': ratio <= ratio_thres,
+                'area': area >= area_threshold,
+                'rmse': errors < error_threshold,
+                'x coord': (margin < centers[:, 0]) & (centers[:, 0] < 1 - margin),
+                'y coord': (margin < centers[:, 1]) & (centers[:, 1] < 1 - margin),
+                'dx': dx < speed_thres * self._last_detection,
+                'dr/r': dr < dr_thres * self._last_detection}
+        return results, cond
+
+    def get_pupil_from_contours(self, contours, small_gray, mask, show_matching=5, verbose=False):
+        min_contour = self._params['min_contour_len']
         err = np.inf
         best_ellipse = None
         best_contour = None
         kernel = np.ones((3, 3))
 
-        results, cond = defaultdict(list), defaultdict(list)
+        inside = cv2.erode(mask, kernel, iterations=1) > 0
+        candidates, ellipses = [], []
         for j, cnt in enumerate(contours):
-
-            mask2 = cv2.erode(mask, kernel, iterations=1)
-            idx = mask2[cnt[..., 1], cnt[..., 0]] > 0
-            cnt = cnt[idx]
+            cnt = cnt.reshape(-1, 2)
+            cnt = cnt[inside[cnt[:, 1], cnt[:, 0]]]
 
             if len(cnt) < min_contour:  # otherwise fitEllipse won't work
                 continue
 
             ellipse = cv2.fitEllipse(cnt)
-            ((x, y), axes, angle) = ellipse
-            if min(axes) == 0:  # otherwise ratio won't work
+            if min(ellipse[1]) == 0:  # otherwise ratio won't work
                 continue
-            ratio = max(axes) / min(axes)
-            area = np.prod(ellipse[1]) / np.prod(small_gray.shape)
-            curr_err = self.goodness_of_fit(cnt, ellipse)
-
-            results['ratio'].append(ratio)
-            results['area'].append(area)
-            results['rmse'].append(curr_err)
-            results['x coord'].append(x / small_gray.shape[1])
-            results['y coord'].append(y / small_gray.shape[0])
-
-            center = np.array([x / small_gray.shape[1], y / small_gray.shape[0]])
-            r = max(axes)
-
-            dr = 0 if self._radius is None else np.abs(r - self._radius) / self._radius
-            dx = 0 if self._center is None else np.sqrt(np.sum((center - self._center) ** 2))
-
-            results['dx'].append(dx)
-            results['dr/r'].append(dr)
-            matching_conditions = 1 * (ratio <= ratio_thres) + 1 * (area >= area_threshold) \
-                                  + 1 * (curr_err < error_threshold) \
-                                  + 1 * (margin < center[0] < 1 - margin) \
-                                  + 1 * (margin < center[1] < 1 - margin) \
-                                  + 1 * (dx < speed_thres * self._last_detection) \
-                                  + 1 * (dr < dr_thres * self._last_detection)
-            cond['ratio'].append(ratio <= ratio_thres)
-            cond['area'].append(area >= area_threshold)
-            cond['rmse'].append(curr_err < error_threshold)
-            cond['x coord'].append(margin < center[0] < 1 - margin)
-            cond['y coord'].append(margin < center[1] < 1 - margin)
-            cond['dx'].append(dx < speed_thres * self._last_detection)
-            cond['dr/r'].append(dr < dr_thres * self._last_detection)
-
-            results['conditions'] = matching_conditions
-            cond['conditions'].append(True)
-
-            if curr_err < err and matching_conditions == 7:
+            candidates.append(cnt)
+            ellipses.append(ellipse)
+
+        if len(ellipses) > 0:
+            errors = np.array([self.goodness_of_fit(cnt, ellipse) for cnt, ellipse in zip(candidates, ellipses)])
+            results, cond = self.score_ellipses(ellipses, errors, small_gray.shape)
+            matching_conditions = np.sum(list(cond.values()), axis=0)
+        else:
+            errors, matching_conditions = np.zeros(0), np.zeros(0, dtype=int)
+
+        for cnt, ellipse, curr_err, matching in zip(candidates, ellipses, errors, matching_conditions):
+            if curr_err < err and matching == len(cond):
                 best_ellipse = ellipse
                 best_contour = cnt
                 err = curr_err
                 cv2.ellipse(small_gray, ellipse, (0, 0, 255), 2)
-            elif matching_conditions >= show_matching:
+            elif matching >= show_matching:
                 cv2.ellipse(small_gray, ellipse, (255, 0, 0), 2)
 
         if best_ellipse is None:
-            df = pd.DataFrame(results)
-            df2 = pd.DataFrame(cond)
-
             print('-', end="", flush=True)
-            if 'conditions' in df.columns and np.any(df['conditions'] >= show_matching):
-                idx = df['conditions'] >= show_matching
-                df = df[idx]
-                df2 = df2[idx]
+            if verbose and np.any(matching_conditions >= show_matching):
+                idx = matching_conditions >= show_matching
+                df = pd.DataFrame(results)[idx]
+                df2 = pd.DataFrame(cond)[idx]
                 df[df2] = np.nan
+                df['conditions'] = matching_conditions[idx]
                 print("\n", df, flush=True)
             self._last_detection += 1
         else:
@@ -418,11 +432,33 @@ class PupilTracker:
 
         return best_contour, best_ellipse
 
+    def get_tracking_mask(self, shape):
+        """ Mask around the last detected ellipse, dilated by dilation_iter pixels (default 10).
+
+        The mask is reused as long as the outline of the last ellipse moves by at most a pixel from
+        the ellipse it was drawn for.
+        """
+        if self._mask_ellipse is not None and self._tracking_mask.shape == shape:
+            (x0, y0), (a0, b0), angle0 = self._mask_ellipse
+            (x, y), (a, b), angle = self._last_ellipse
+            dangle = np.deg2rad(abs((angle - angle0 + 90) % 180 - 90))
+            if (abs(x - x0) <= 1 and abs(y - y0) <= 1 and abs(a - a0) <= 1 and abs(b - b0) <= 1
+                    and abs(a - b) / 2 * dangle <= 1):
+                return self._tracking_mask
+
+        n = int(self._params.get('dilation_iter', 10))
+        mask = np.zeros(shape, dtype=np.uint8)
+        cv2.ellipse(mask, tuple(self._last_ellipse), (255), thickness=cv2.FILLED)
+        # a single dilation with a (2n + 1)-square kernel equals n dilations with a 3 x 3 one
+        self._tracking_mask = cv2.dilate(mask, np.ones((2 * n + 1, 2 * n + 1), dtype=np.uint8))
+        self._mask_ellipse = self._last_ellipse
+        return self._tracking_mask
+
     _running_avg = None
+    _blur = None
 
-    def preprocess_image(self, frame, eye_roi):
+    def preprocess_image(self, gray, eye_roi):
         h = int(self._params['gaussian_blur'])
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         img_std = np.std(gray)
 
         small_gray = gray[slice(*eye_roi[0]), slice(*eye_roi[1])]
@@ -431,19 +467,25 @@ class PupilTracker:
         if 'extreme_meso' in self._params and self._params['extreme_meso']:
             c = self._params['running_avg']
             p = self._params['exponent']
+            powered = cv2.LUT(small_gray, power_lut(p, np.float32))
             if self._running_avg is None:
-                self._running_avg = np.array(small_gray / 255) ** p * 255
+                self._running_avg = powered
             else:
-                self._running_avg = c * np.array(small_gray / 255) ** p * 255 + (1 - c) * self._running_avg
+                cv2.accumulateWeighted(powered, self._running_avg, c)
                 small_gray = self._running_avg.astype(np.uint8)
-                cv2.imshow('power', small_gray)
                 # small_gray += self._running_avg.astype(np.uint8) - small_gray  # big hack
         # --- mesosetting end
 
-        blur = cv2.GaussianBlur(small_gray, (2 * h + 1, 2 * h + 1), 0)  # play with blur
+        if self._blur is None or self._blur.shape != small_gray.shape:
+            self._blur = np.empty_like(small_gray)
+        blur = self._blur
+        if h > 0:
+            cv2.GaussianBlur(small_gray, (2 * h + 1, 2 * h + 1), 0, dst=blur)  # play with blur
+        else:  # a 1x1 gaussian kernel is the identity
+            blur[...] = small_gray
 
         _, thres = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        return gray, small_gray, img_std, thres, blur
+        return small_gray, img_std, thres, blur
 
     @staticmethod
     def display(gray, blur, thres, eye_roi, fr_count, n_frames, ncontours=0, contour=None, ellipse=None,
@@ -467,33 +509,66 @@ class PupilTracker:
             gray[epx - 3:epx + 3, epy - 3:epy + 3] = 0
         cv2.imshow('frame', gray)
 
-    def track(self, videofile, eye_roi, display=False):
-        contrast_low = self._params['contrast_threshold']
-        mask_kernel = np.ones((3, 3))
+    def track(self, videofile, eye_roi, display=False, num_processes=1, warmup=50):
+        """ Tracks the pupil in every frame of videofile.
 
+        With num_processes > 1 (and no display) the video is split into contiguous chunks that are
+        tracked in parallel. Each process first tracks the warmup frames preceding its chunk to seed
+        the last ellipse, center and radius used to match the pupil between frames.
+
+        Returns a dict of per-frame traces (frame_id, center, major_r, rotated_rect,
+        frame_intensity, contour). Frames without a detected pupil are NaN, or None for contour.
+        """
         print("Tracking videofile", videofile)
         cap = cv2.VideoCapture(videofile)
-        traces = []
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        if display or num_processes == 1:
+            traces = self.track_frames(videofile, eye_roi, 0, n_frames, display=display)
+        else:
+            bounds = np.linspace(0, n_frames, num_processes + 1).astype(int)
+            args = [(self._params, self._mask, videofile, eye_roi, start, stop, warmup)
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+            with mp.Pool(num_processes) as pool:
+                chunks = pool.starmap(_track_chunk, args)
+            traces = {k: np.concatenate([chunk[k] for chunk in chunks]) for k in chunks[0] if k != 'contour'}
+            traces['contour'] = [contour for chunk in chunks for contour in chunk['contour']]
+        print("Reached end of videofile ", videofile)
+
+        if display:
+            cv2.destroyAllWindows()
+
+        return traces
+
+    def track_frames(self, videofile, eye_roi, start, stop, display=False, warmup=0):
+        """ Tracks the pupil in frames [start, stop) of videofile. The warmup frames preceding start
+        are tracked as well but not returned. See track for the returned traces.
+        """
+        contrast_low = self._params['contrast_threshold']
 
+        cap = cv2.VideoCapture(videofile)
         n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fr_count = 0
+        cap.release()
+        first = max(start - warmup, 0)
+        frames = read_gray_frames(videofile, start=first)
+
+        traces = dict(frame_id=np.arange(first + 1, stop + 1),
+                      center=np.full((stop - first, 2), np.nan),
+                      major_r=np.full(stop - first, np.nan),
+                      rotated_rect=np.full((stop - first, 5), np.nan),
+                      frame_intensity=np.full(stop - first, np.nan),
+                      contour=[None] * (stop - first))
         if self._mask is not None:
             small_mask = self._mask[slice(*eye_roi[0]), slice(*eye_roi[1])].squeeze()
         else:
             small_mask = np.ones(np.diff(eye_roi, axis=1).squeeze().astype(int), dtype=np.uint8)
 
-        while cap.isOpened():
-            if fr_count >= n_frames:
-                print("Reached end of videofile ", videofile)
-                break
-
-            # --- read frame
-            ret, frame = cap.read()
-            fr_count += 1
+        for fr_count, gray in zip(range(first + 1, stop + 1), frames):
+            i = fr_count - 1 - first
 
             # --- if we don't get a frame, don't add any tracking results
-            if not ret:
-                traces.append(dict(frame_id=fr_count))
+            if gray is None:
                 continue
 
             # --- print out if there's not display
@@ -501,12 +576,13 @@ class PupilTracker:
                 print("\tframe ({}/{})".format(fr_count, n_frames))
 
             # --- preprocess and treshold images
-            gray, small_gray, img_std, thres, blur = self.preprocess_image(frame, eye_roi)
+            small_gray, img_std, thres, blur = self.preprocess_image(gray, eye_roi)
+            if display and self._params.get('extreme_meso'):
+                cv2.imshow('power', small_gray)
 
             # --- if contrast is too low, skip it
             if img_std < contrast_low:
-                traces.append(dict(frame_id=fr_count,
-                                   frame_intensity=img_std))
+                traces['frame_intensity'][i] = img_std
                 print('_', end="", flush=True)
                 if display:
                     self.display(gray, blur, thres, eye_roi, fr_count, n_frames)
@@ -516,43 +592,76 @@ class PupilTracker:
             ellipse, eye_center, contour = None, None, None
 
             if self._last_ellipse is not None:
-                mask = np.zeros(small_mask.shape, dtype=np.uint8)
-                cv2.ellipse(mask, tuple(self._last_ellipse), (255), thickness=cv2.FILLED)
-                # cv2.drawContours(mask, [self._last_contour], -1, (255), thickness=cv2.FILLED)
-                mask = cv2.dilate(mask, mask_kernel, iterations=self.dilation_iter.value)
-                thres *= mask
+                thres *= self.get_tracking_mask(small_mask.shape)
             thres *= small_mask
 
-            _, contours, hierarchy1 = cv2.findContours(thres.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            contour, ellipse = self.get_pupil_from_contours(contours, blur, small_mask)
+            _, contours, hierarchy1 = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            contour, ellipse = self.get_pupil_from_contours(contours, blur, small_mask, verbose=display)
 
             self._last_ellipse = ellipse
 
-            if contour is None:
-                traces.append(dict(frame_id=fr_count, frame_intensity=img_std))
-            else:
+            traces['frame_intensity'][i] = img_std
+            if contour is not None:
                 eye_center = eye_roi[::-1, 0] + np.asarray(ellipse[0])
                 self._center = np.asarray(ellipse[0]) / np.asarray(small_gray.shape[::-1])
                 self._radius = max(ellipse[1])
 
-                traces.append(dict(center=eye_center,
-                                   major_r=np.max(ellipse[1]),
-                                   rotated_rect=np.hstack(ellipse),
-                                   contour=contour.astype(np.int16),
-                                   frame_id=fr_count,
-                                   frame_intensity=img_std
-                                   ))
+                traces['center'][i] = eye_center
+                traces['major_r'][i] = np.max(ellipse[1])
+                traces['rotated_rect'][i] = np.hstack(ellipse)
+                traces['contour'][i] = contour.astype(np.int16, copy=False)
             if display:
                 self.display(self._mask * gray if self._mask is not None else gray, blur, thres, eye_roi,
                              fr_count, n_frames, ellipse=ellipse,
                              eye_center=eye_center, contour=contour, ncontours=len(contours))
-            if (cv2.waitKey(1) & 0xFF == ord('q')):
-                raise PipelineException('Tracking aborted')
+                if (cv2.waitKey(1) & 0xFF == ord('q')):
+                    raise PipelineException('Tracking aborted')
 
-        cap.release()
-        cv2.destroyAllWindows()
+        frames.close()
+
+        return {k: v[start - first:stop - first] for k, v in traces.items()}
+
+
+def _track_chunk(param, mask, videofile, eye_roi, start, stop, warmup):
+    """ Tracks frames [start, stop) of videofile with a fresh PupilTracker (used by PupilTracker.track). """
+    return PupilTracker(param, mask=mask).track_frames(videofile, eye_roi, start, stop, warmup=warmup)
 
-        return traces
+
+def read_gray_frames(videofile, start=0):
+    """ Yields the frames of videofile from frame number start on as 2-d uint8 grayscale images,
+    or None for frames that could not be read.
+
+    Frames are decoded with PyAV (multithreaded, straight to grayscale) if it is installed and
+    with cv2.VideoCapture otherwise. If PyAV hits corrupt data, the remaining frames are read with
+    cv2.VideoCapture, which returns None for the frames it cannot read.
+    """
+    if av is not None:
+        try:
+            with av.open(videofile) as container:
+                stream = container.streams.video[0]
+                stream.thread_type = 'AUTO'
+                frames_per_pts = stream.average_rate * stream.time_base
+                pts0 = stream.start_time or 0
+                if start > 0:
+                    container.seek(pts0 + int(start / frames_per_pts), stream=stream)  # lands on a keyframe before start
+                for frame in container.decode(stream):
+                    if frame.pts is not None and round((frame.pts - pts0) * frames_per_pts) < start:
+                        continue
+                    yield frame.to_ndarray(format='gray8')
+                    start += 1
+            return
+        except av.error.InvalidDataError as e:
+            print('PyAV failed at frame {} of {} ({}), reading on with cv2'.format(start, videofile, e))
+
+    cap = cv2.VideoCapture(videofile)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    try:
+        while True:
+            ret, frame = cap.read()
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if ret else None
+    finally:
+        cap.release()
 
 
 def adjust_gamma(image, gamma=1.0):
@@ -565,6 +674,11 @@ def adjust_gamma(image, gamma=1.0):
     # apply gamma correction using the lookup table
     return cv2.LUT(image, table)
 
+@lru_cache(maxsize=32)
+def power_lut(power, dtype=np.float64):
+    """ Lookup table for cv2.LUT mapping uint8 pixel values x to (x / 255) ** power * 255. """
+    return ((np.arange(256) / 255) ** power * 255).astype(dtype)
+
 def identity(x):
     return x
 
@@ -595,8 +709,11 @@ class Parameter:
             self._value = min(self._value, self.max)
         print(self.name, 'new value:', self._value)
 
-    def log(self, i):
-        self._log[i] = self.value
+    def log(self, i, stop=None):
+        if stop is None:
+            self._log[i] = self.value
+        else:  # frames i to stop
+            self._log[i:stop] = [self.value] * (stop - i)
 
     @property
     def logtrace(self):
@@ -609,6 +726,68 @@ class Parameter:
             self._log = None
 
 
+class FrameReader:
+    """ Decodes frames from a cv2.VideoCapture in a background thread.
+
+    Up to maxsize frames are read ahead into a bounded queue, so decoding the next frames overlaps
+    with processing the current one while memory stays bounded. The capture is only touched by
+    the reader thread once the FrameReader is started.
+
+    Frames that follow the last decoded frame within decode_interval seconds are only grabbed,
+    not decoded, and read returns None for them.
+    """
+
+    def __init__(self, cap, maxsize=3):
+        self._cap = cap
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._seek_to = None
+        self._generation = 0  # frames read before the last seek are dropped
+        self._stopped = False
+        self.decode_interval = 0
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def _read_loop(self):
+        last_decode = -np.inf
+        while not self._stopped:
+            with self._lock:
+                if self._seek_to is not None:
+                    self._cap.set(cv2.CAP_PROP_POS_FRAMES, self._seek_to)
+                    self._seek_to = None
+                    last_decode = -np.inf
+                generation = self._generation
+                now = time.monotonic()
+                if now - last_decode < self.decode_interval:
+                    ret, frame = self._cap.grab(), None
+                else:
+                    ret, frame = self._cap.read()
+                    last_decode = now
+            while not self._stopped:
+                try:
+                    self._queue.put((generation, ret, frame), timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def read(self):
+        """ Returns the next (ret, frame) like cv2.VideoCapture.read. """
+        while True:
+            generation, ret, frame = self._queue.get()
+            if generation == self._generation:
+                return ret, frame
+
+    def seek(self, frame_number):
+        """ Makes frame_number the next frame returned by read. """
+        with self._lock:
+            self._seek_to = frame_number
+            self._generation += 1
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+
+
 class ManualTracker:
     MAIN_WINDOW = "Main Window"
     ROI_WINDOW = "ROI"
@@ -620,6 +799,18 @@ class ManualTracker:
     BLOCK = 0
 
     DEBUG = True
+    DISPLAY_RATE = 60  # maximal refresh rate of the main window in Hz
+    PLOT_RATE = 30  # maximal refresh rate of the area graph in Hz
+    NUM_THREADS = 2  # OpenCV threads while running interactively, leaving a core to the FrameReader
+    UMAT_MIN_SIZE = 256 * 256  # ROIs with fewer pixels are filtered faster on the CPU than with OpenCL
+
+    _last_display = 0.
+    _last_plot = 0.
+    _show_preview = True  # draw contours and show the ROI and thresholded windows
+    _cached_roi = None
+    _mask_version = 0  # incremented on every edit of the block mask
+    _small_mask_version = None
+    _display_mask_version = None
 
     def add_track_bar(self, description, parameter, window=None):
         cv2.createTrackbar(description,
@@ -682,14 +873,16 @@ class ManualTracker:
                 self.area[i] = 0
             else:
                 area = cv2.drawContours(area, [c], -1, (255), thickness=cv2.FILLED)
-                self.area[i] = (area > 0).sum()
-                area *= 0
+                self.area[i] = cv2.countNonZero(area)
+                area.fill(0)
         self.plot_area()
 
     def reset(self):
         self.pause = False
         self.step = 50
         self._cap = None
+        self._reader = None
+        self._buffers = {}
         self._frame_number = None
         self._n_frames = None
         self._last_frame = None
@@ -718,7 +911,7 @@ class ManualTracker:
         self.t1 = None
         self.scroll_window = False
 
-        self.dilation_kernel = np.ones((3, 3))
+        self.dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
 
         self.histogram_equalize = False
 
@@ -748,9 +941,9 @@ class ManualTracker:
         for p in self.parameters:
             p.flush_log()
 
-    def log_parameters(self, i):
+    def log_parameters(self, i, stop=None):
         for p in self.parameters:
-            p.log(i)
+            p.log(i, stop)
 
 
     def mouse_callback(self, event, x, y, flags, param):
@@ -761,11 +954,13 @@ class ManualTracker:
             color = (0, 0, 0) if self.mask_mode == self.BLOCK else (255, 255, 255)
             if mask is not None:
                 cv2.circle(mask, (x, y), self.brush.value, color, -1)
+                self._mask_version += 1
         elif event == cv2.EVENT_RBUTTONDOWN:
             mask = self._mask if self.mask_mode == self.BLOCK else self._merge_mask
             color = (0, 0, 0) if self.mask_mode == self.MERGE else (255, 255, 255)
             if mask is not None:
                 cv2.circle(mask, (x, y), self.brush.value, color, -1)
+                self._mask_version += 1
         elif event == cv2.EVENT_MBUTTONDOWN:
             self.roi_start = (x, y)
             self._drag = True
@@ -808,7 +1003,7 @@ class ManualTracker:
             else:
                 t0, t1 = self.del_tmp, t1
             self.contours_detected[t0:t1] = False
-            self.contours[t0:t1] = None
+            self.contours[t0:t1] = [None] * (t1 - t0)
 
     def process_key(self, key):
         if key == ord('q'):
@@ -831,11 +1026,12 @@ class ManualTracker:
         elif key == ord('r'):
             self.roi_start = None
             self.roi_end = None
-            self.roi = None
+            self.roi.set(None)
             return True
         elif key == ord('c'):
             self._mask = np.ones_like(self._mask) * 255
             self._merge_mask = np.zeros_like(self._merge_mask)
+            self._mask_version += 1
         elif key == ord('h'):
             self.help = not self.help
             return True
@@ -845,6 +1041,9 @@ class ManualTracker:
         elif key == ord('t'):
             self.focus_window()
             return True
+        elif key == ord('p'):
+            self._show_preview = not self._show_preview
+            return True
         elif key == ord('w'):
             self.scroll_window = ~self.scroll_window
             self.t0 = max(0, self._frame_number - self.window_size)
@@ -867,6 +1066,7 @@ class ManualTracker:
         h       : toggle help
         m       : toggle mask mode
         t       : focus window on cursor
+        p       : toggle contour preview
         w       : toggle scrolling window
         
         MOUSE:  
@@ -907,19 +1107,17 @@ class ManualTracker:
                 self._frame_number += 1
 
             self.update_frame = False
-            ret, frame = self._cap.read()
+            ret, frame = self._reader.read()
+            if frame is None:  # not decoded or not read
+                return ret, None
 
-            self._last_frame = ret, frame
             if self._mask is None:
                 self._mask = np.ones_like(frame) * 255
             if self._merge_mask is None:
                 self._merge_mask = np.zeros_like(frame)
 
             self._last_frame = ret, frame
-            if ret and frame is not None:
-                return ret, frame.copy()
-            else:
-                return ret, None
+            return ret, frame.copy()
         else:
             ret, frame = self._last_frame
             return ret, frame.copy()
@@ -928,11 +1126,10 @@ class ManualTracker:
         h = self.blur.value
 
         if self.power.value > 1:
-            frame = np.array(frame / 255) ** self.power.value * 255
-            frame = frame.astype(np.uint8)
+            frame = cv2.LUT(frame, power_lut(self.power.value, np.uint8))
 
         if self.histogram_equalize:
-            cv2.equalizeHist(frame, frame)
+            frame = cv2.equalizeHist(frame)
 
         if self._running_mean is None or frame.shape != self._running_mean.shape:
             self._running_mean = np.array(frame)
@@ -941,6 +1138,9 @@ class ManualTracker:
             self._running_mean = np.uint8(a * frame + (1 - a) * self._running_mean)
             frame = np.array(self._running_mean)
 
+        if frame.size >= self.UMAT_MIN_SIZE and cv2.ocl.useOpenCL():
+            frame = cv2.UMat(frame)  # keeps the images on the device for the filters below
+
         blur = cv2.GaussianBlur(frame, (2 * h + 1, 2 * h + 1), 0)
         _, thres = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
         mask = cv2.erode(thres, self.dilation_kernel, iterations=self.dilation_iter.value)
@@ -949,30 +1149,31 @@ class ManualTracker:
         return thres, blur, mask
 
     def find_contours(self, thres):
-        contours, hierarchy = cv2.findContours(thres, cv2.RETR_TREE,
-                                                  cv2.CHAIN_APPROX_SIMPLE)  # remove copy when cv2=3.2 is installed
-        if len(contours) > 1:
-            contours = [c for i, c in enumerate(contours) if hierarchy[0, i, 3] == -1]
-        contours = [cv2.convexHull(c) for c in contours]
+        contours, hierarchy = cv2.findContours(thres, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # keep the convex hulls of outermost contours only
+        contours = [cv2.convexHull(c) for c, h in zip(contours, hierarchy[0] if hierarchy is not None else [])
+                    if h[3] == -1]
 
         if len(contours) > 1 and self._merge_mask is not None and np.any(self._merge_mask > 0):
-            small_merge_mask = self._merge_mask[slice(*self.roi.value[0]), slice(*(self.roi.value[1] + 1)), 0]
+            small_merge_mask = self._merge_mask[self._mask_slices + (0,)]
             merge = []
             other = []
-            for i in range(len(contours)):
-                tmp = np.zeros_like(thres)
-                cv2.drawContours(tmp, contours, i, (255), thickness=cv2.FILLED)
-                cv2.bitwise_and(tmp, small_merge_mask, dst=tmp)
-                if tmp.sum() > 0:
-                    merge.append(contours[i])
+            for c in contours:
+                # test the overlap within the bounding box of the contour only
+                x, y, w, h = cv2.boundingRect(c)
+                tmp = np.zeros((h, w), dtype=np.uint8)
+                cv2.drawContours(tmp, [c], -1, (255), thickness=cv2.FILLED, offset=(-x, -y))
+                cv2.bitwise_and(tmp, small_merge_mask[y:y + h, x:x + w], dst=tmp)
+                if cv2.countNonZero(tmp) > 0:
+                    merge.append(c)
                 else:
-                    other.append(contours[i])
+                    other.append(c)
 
             contours = ([cv2.convexHull(np.vstack(merge))] if len(merge) > 0 else []) + other
 
-        contours = [c + self.roi.value[::-1, 0][None, None, :] for c in contours if len(c) >= self.min_contour_len.value]
-
-        return contours
+        offset = self.roi.value[::-1, 0][None, None, :]
+        min_len = self.min_contour_len.value
+        return [c + offset for c in contours if len(c) >= min_len]
 
     def focus_window(self):
         self.t0 = max(self._frame_number - 250, 0)
@@ -981,7 +1182,7 @@ class ManualTracker:
     def goto_frame(self, no):
         self._running_mean = None
         self._frame_number = min(max(no, 0), self._n_frames - 1)
-        self._cap.set(cv2.CAP_PROP_POS_FRAMES, self._frame_number)
+        self._reader.seek(self._frame_number)
         self.update_frame = True
 
     def normalize_graph(self, signal, min_zero=True):
@@ -1003,10 +1204,13 @@ class ManualTracker:
 
         area = self.normalize_graph(self.area[idx])
 
-        detected = self.contours_detected[idx]
-        for x, y1, y2, det1, det2 in zip(count(), area[:-1], area[1:], detected[:-1], detected[1:]):
-            if det1 and det2:
-                graph = cv2.line(graph, (x, y1), (x + 1, y2), (209, 133, 4), thickness=2)
+        # draw the area as one polyline per run of consecutive detections
+        detected = np.concatenate(([False], self.contours_detected[idx], [False]))
+        starts, = np.where(~detected[:-1] & detected[1:])
+        stops, = np.where(detected[:-1] & ~detected[1:])
+        points = np.stack((np.arange(len(area)), area), axis=1).astype(np.int32)
+        runs = [points[start:stop, None, :] for start, stop in zip(starts, stops) if stop - start > 1]
+        cv2.polylines(graph, runs, False, (209, 133, 4), thickness=2)
 
         if t0 <= self._frame_number <= t1:
             x = int((self._frame_number - t0) / dt * self._progress_len)
@@ -1021,124 +1225,286 @@ class ManualTracker:
         for frame_number, *params in zip(count(), *map(attrgetter('logtrace'), self.parameters)):
             yield dict(zip(names, params), frame_id=frame_number)
 
+    def update_decoding(self):
+        """ Makes the reader decode every frame while frames are processed or paused on. Otherwise
+        frames are only shown, so decoding them faster than DISPLAY_RATE is wasted.
+        """
+        decode_all = self.pause or (not self.skip and self.roi.value is not None)
+        interval = 0 if decode_all else 1 / self.DISPLAY_RATE
+        if interval != self._reader.decode_interval:
+            self._reader.decode_interval = interval
+            if decode_all:  # re-read the current and read-ahead frames decoded
+                self.goto_frame(self._frame_number)
+
+    def update_roi_cache(self):
+        """ Recomputes the slices and offset derived from the ROI if it changed since the last call. """
+        roi = self.roi.value
+        if roi is self._cached_roi:
+            return
+        self._cached_roi = roi
+        self._small_mask_version = None
+        if roi is not None:
+            self._roi_slices = slice(*roi[0]), slice(*roi[1])  # ROI in the frame
+            self._mask_slices = slice(*roi[0]), slice(*(roi[1] + 1))  # ROI in the masks
+            self._contour_offset = tuple(-roi[::-1, 0])  # from frame to ROI coordinates
+
+    def get_small_mask(self):
+        """ Returns the block mask within the ROI, or None if it does not block any pixel there.
+
+        The result is cached until the ROI changes or the mask is edited.
+        """
+        if self._small_mask_version != self._mask_version:
+            small_mask = np.ascontiguousarray(self._mask[self._mask_slices + (0,)])
+            self._small_mask = small_mask if cv2.countNonZero(small_mask) < small_mask.size else None
+            self._small_mask_version = self._mask_version
+        return self._small_mask
+
+    def get_display_mask(self):
+        """ Returns the block mask resized to the main window, cached until the mask is edited. """
+        if self._display_mask_version != self._mask_version:
+            self._display_mask = cv2.resize(self._mask, self.dsize, interpolation=cv2.INTER_NEAREST)
+            self._display_mask_version = self._mask_version
+        return self._display_mask
+
+    def get_buffer(self, name, shape, dtype=np.uint8):
+        """ Returns the scratch buffer name, reallocated whenever shape or dtype change. """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def process_frame(self, frame):
+        """ Thresholds the ROI of a BGR frame and finds the pupil contour candidates in it.
+
+        Returns the preprocessed ROI, the masked threshold image and the contours in frame coordinates.
+        """
+        self.update_roi_cache()
+        roi_frame = frame[self._roi_slices]
+        small_gray = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY,
+                                  dst=self.get_buffer('small_gray', roi_frame.shape[:2]))
+        thres, small_gray, dilation_mask = self.preprocess_image(small_gray)
+        if self._mask is not None:
+            small_mask = self.get_small_mask()
+            if small_mask is not None:
+                cv2.bitwise_and(thres, small_mask, dst=thres)
+            cv2.bitwise_and(thres, dilation_mask, dst=thres)
+        if isinstance(thres, cv2.UMat):
+            small_gray, thres = small_gray.get(), thres.get()
+
+        return small_gray, thres, self.find_contours(thres)
+
+    def contour_area(self, contour, shape):
+        """ Returns the number of pixels inside a contour in frame coordinates, drawn in a ROI of the given shape. """
+        area = self.get_buffer('area', shape)
+        area.fill(0)
+        cv2.drawContours(area, [contour], -1, (255), thickness=cv2.FILLED, offset=self._contour_offset)
+        return cv2.countNonZero(area)
+
+    def track_frames(self, start, stop, warmup=0):
+        """ Tracks frames [start, stop) without GUI using the current ROI, masks and parameters. The warmup
+        frames preceding start only feed the running average.
+
+        Returns arrays of contours_detected and area, and the list of contours for these frames.
+        """
+        cap = cv2.VideoCapture(self.videofile)
+        first = max(start - warmup, 0)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+        self._buffers = {}
+        self._running_mean = None
+        self.pause = False
+
+        detected = np.zeros(stop - start, dtype=bool)
+        area = np.zeros(stop - start)
+        contours = [None] * (stop - start)
+        for i in range(first - start, stop - start):  # warmup frames have negative indices
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            small_gray, _, frame_contours = self.process_frame(frame)
+            if i >= 0 and len(frame_contours) == 1:
+                detected[i] = True
+                area[i] = self.contour_area(frame_contours[0], small_gray.shape)
+                contours[i] = frame_contours[0]
+        cap.release()
+        return detected, area, contours
+
+    def run_headless(self, start=0, stop=None, num_processes=None, warmup=50):
+        """ Tracks frames [start, stop) without GUI using the current ROI, masks and parameters, e.g. as left
+        by a previous interactive run. The frames are split into one chunk per process.
+
+        Args:
+            start, stop: Range of frames to track; stop defaults to the end of the video.
+            num_processes: Number of worker processes; defaults to the number of CPUs.
+            warmup: Number of frames preceding each chunk used to warm up the running average.
+        """
+        assert self.roi.value is not None, 'ROI must be set before tracking'
+        cap = cv2.VideoCapture(self.videofile)
+        self._n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        stop = self._n_frames if stop is None else min(stop, self._n_frames)
+        num_processes = num_processes or mp.cpu_count()
+
+        if self.contours is None or len(self.contours) != self._n_frames:
+            self.area = np.zeros(self._n_frames)
+            self.contours_detected = np.zeros(self._n_frames, dtype=bool)
+            self.contours = [None] * self._n_frames
+            self.set_log_size(self._n_frames)
+            self.flush_parameter_log()
+
+        # workers get a copy without the video handles and the results tracked so far
+        worker = copy.copy(self)
+        worker._cap, worker._reader, worker._buffers = None, None, {}
+        worker.area = worker.contours_detected = worker.contours = None
+
+        bounds = np.linspace(start, stop, min(num_processes, stop - start) + 1).astype(int)
+        args = [(worker, a, b, warmup) for a, b in zip(bounds[:-1], bounds[1:])]
+        # split the cores between the processes instead of every process using all of them
+        num_threads = max(mp.cpu_count() // num_processes, 1)
+        with mp.Pool(num_processes, initializer=cv2.setNumThreads, initargs=(num_threads,)) as pool:
+            chunks = pool.starmap(_track_manual_chunk, args)
+
+        for a, b, (detected, area, contours) in zip(bounds[:-1], bounds[1:], chunks):
+            self.contours_detected[a:b] = detected
+            self.area[a:b] = area
+            self.contours[a:b] = contours
+        self.log_parameters(start, stop)
+
     def backup(self):
-        cap = self._cap
-        self._cap = None
+        cap, reader, buffers = self._cap, self._reader, self._buffers
+        self._cap, self._reader, self._buffers = None, None, {}
         print('Saving tracker to', self.backup_file)
         pickle.dump(self, open(self.backup_file, 'wb'), pickle.HIGHEST_PROTOCOL)
-        self._cap = cap
+        self._cap, self._reader, self._buffers = cap, reader, buffers
 
     def run(self):
         iterations = 0
         self._cap = cap = cv2.VideoCapture(self.videofile)
+        if not cap.isOpened():
+            raise PipelineException('Could not open {}'.format(self.videofile))
 
         self._n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        self.set_log_size(self._n_frames)
-        self.flush_parameter_log()
-
-        self._frame_number = 0
-        self.update_frame = True  # ensure correct starting conditions
-        self.t0 = 0
-        self.t1 = self._n_frames
-
-        if self.contours_detected is not None and self.contours_detected is not None:
-            self.recompute_area()
-            self.pause = True
-        else:
-            self.area = np.zeros(self._n_frames)
-            self.contours_detected = np.zeros(self._n_frames, dtype=bool)
-            self.contours = np.zeros(self._n_frames, dtype=object)
-            self.contours[:] = None
-
-        while cap.isOpened():
-            if not self.pause:
-                iterations += 1
-                if iterations % self.backup_interval == self.backup_interval - 1:
-                    self.backup()
-
-            if self._frame_number >= self._n_frames - 1:
-                if not self.pause:
-                    print("Reached end of videofile. Press Q to exit. Or go back to fix stuff.", self.videofile)
+        self._buffers = {}
+        # monotonic times from a backup made before a reboot may lie in the future
+        self._last_display = self._last_plot = 0.
+
+        num_threads = cv2.getNumThreads()  # restored when done, other trackers may run in this process
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(self.NUM_THREADS)
+        self._reader = FrameReader(cap)
+        try:
+            self.set_log_size(self._n_frames)
+            self.flush_parameter_log()
+
+            self._frame_number = 0
+            self.update_frame = True  # ensure correct starting conditions
+            self.t0 = 0
+            self.t1 = self._n_frames
+
+            if self.contours_detected is not None and self.contours_detected is not None:
+                self.recompute_area()
                 self.pause = True
+            else:
+                self.area = np.zeros(self._n_frames)
+                self.contours_detected = np.zeros(self._n_frames, dtype=bool)
+                self.contours = [None] * self._n_frames
 
-            self.log_parameters(self._frame_number)
-            ret, frame = self.read_frame()
-
-            if self.scroll_window and not self.pause:
-                self.t0 = min(self.t0 + 1, self._n_frames - self.scroll_window)
-                self.t1 = min(self.t1 + 1, self._n_frames)
-
-            if ret and self.roi_start is not None and self.roi_end is not None:
-                cv2.rectangle(frame, self.roi_start, self.roi_end, (0, 255, 255), 2)
-
-            if ret and not self.skip and self.roi.value is not None:
-                small_gray = cv2.cvtColor(frame[slice(*self.roi.value[0]), slice(*self.roi.value[1]), :],
-                                          cv2.COLOR_BGR2GRAY)
+            # the capture belongs to the FrameReader thread from here on; the loop only ends on 'q'
+            while True:
+                if not self.pause:
+                    iterations += 1
+                    if iterations % self.backup_interval == self.backup_interval - 1:
+                        self.backup()
 
-                try:
-                    thres, small_gray, dilation_mask = self.preprocess_image(small_gray)
-                except Exception as e:
-                    print('Problems with processing reversing to frame', self._frame_number - 10, 'Please redraw ROI')
-                    print('Error message is', str(e))
-                    self.goto_frame(self._frame_number - 10)
-                    self.roi_start = self.roi_end = self.roi = None
+                if self._frame_number >= self._n_frames - 1:
+                    if not self.pause:
+                        print("Reached end of videofile. Press Q to exit. Or go back to fix stuff.", self.videofile)
                     self.pause = True
-                    if self.DEBUG:
-                        raise
-                else:
-                    if self._mask is not None:
-                        small_mask = self._mask[slice(*self.roi.value[0]), slice(*(self.roi.value[1] + 1)), 0]
-                        cv2.bitwise_and(thres, small_mask, dst=thres)
-                        cv2.bitwise_and(thres, dilation_mask, dst=thres)
-
-                    contours = self.find_contours(thres)
-                    cv2.drawContours(frame, contours, -1, (0, 255, 0), 3)
-                    cv2.drawContours(small_gray, contours, -1, (127, 127, 127), 3,
-                                     offset=tuple(-self.roi.value[::-1, 0]))
-                    if len(contours) > 1:
-                        if not self.pause:
-                            self._skipped_frames += 1
-                        if self._skipped_frames > self.frame_tolerance.value:
-                            self.pause = True
-                    elif len(contours) == 1:
-                        self._skipped_frames = 0
-                        area = np.zeros_like(small_gray)
-                        area = cv2.drawContours(area, contours, -1, (255), thickness=cv2.FILLED,
-                                                offset=tuple(-self.roi.value[::-1, 0]))
-                        self.area[self._frame_number] = (area > 0).sum()
-                        self.contours_detected[self._frame_number] = True
-                        self.contours[self._frame_number] = contours[0]
-                    else:
-                        self._skipped_frames = 0
-
-                    cv2.imshow(self.ROI_WINDOW, small_gray)
-                    cv2.imshow(self.THRESHOLDED_WINDOW, thres)
-
-            # --- plotting
-            if self._merge_mask is not None:
-                if np.any(self._merge_mask > 0):
-                    tm = cv2.cvtColor(self._merge_mask, cv2.COLOR_BGR2GRAY)
-                    _, tm = cv2.threshold(tm, 127, 255, cv2.THRESH_BINARY)
-                    _, mcontours, _ = cv2.findContours(tm, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                    cv2.drawContours(frame, mcontours, -1, (0, 140, 255), thickness=3)
-
-            self.display_frame_number(frame)
-            cv2.bitwise_and(frame, self._mask, dst=frame)
-            if self._scale_factor is None:
-                self._scale_factor = self._width / frame.shape[1]
-                self.dsize = tuple(int(self._scale_factor * s) for s in frame.shape[:2])[::-1]
-            frame = cv2.resize(frame, self.dsize)
-            cv2.imshow(self.MAIN_WINDOW, frame)
-            self.plot_area()
-
-            if not self.process_key(cv2.waitKey(5) & 0xFF):
-                break
 
-        cap.release()
+                self.log_parameters(self._frame_number)
+                self.update_decoding()
+                ret, frame = self.read_frame()
+
+                if self.scroll_window and not self.pause:
+                    self.t0 = min(self.t0 + 1, self._n_frames - self.scroll_window)
+                    self.t1 = min(self.t1 + 1, self._n_frames)
+
+                if frame is not None and self.roi_start is not None and self.roi_end is not None:
+                    cv2.rectangle(frame, self.roi_start, self.roi_end, (0, 255, 255), 2)
+
+                if frame is not None and not self.skip and self.roi.value is not None:
+                    try:
+                        small_gray, thres, contours = self.process_frame(frame)
+                    except Exception as e:
+                        print('Problems with processing reversing to frame', self._frame_number - 10,
+                              'Please redraw ROI')
+                        print('Error message is', str(e))
+                        self.goto_frame(self._frame_number - 10)
+                        self.roi_start = self.roi_end = None
+                        self.roi.set(None)
+                        self.pause = True
+                        if self.DEBUG:
+                            raise
+                    else:
+                        if self._show_preview:
+                            cv2.drawContours(frame, contours, -1, (0, 255, 0), 3)
+                            cv2.drawContours(small_gray, contours, -1, (127, 127, 127), 3,
+                                             offset=self._contour_offset)
+                        if len(contours) > 1:
+                            if not self.pause:
+                                self._skipped_frames += 1
+                            if self._skipped_frames > self.frame_tolerance.value:
+                                self.pause = True
+                        elif len(contours) == 1:
+                            self._skipped_frames = 0
+                            self.area[self._frame_number] = self.contour_area(contours[0], small_gray.shape)
+                            self.contours_detected[self._frame_number] = True
+                            self.contours[self._frame_number] = contours[0]
+                        else:
+                            self._skipped_frames = 0
+
+                        if self._show_preview:
+                            cv2.imshow(self.ROI_WINDOW, small_gray)
+                            cv2.imshow(self.THRESHOLDED_WINDOW, thres)
+
+                # --- plotting (frames coming in faster than DISPLAY_RATE are not shown in the main window)
+                now = time.monotonic()
+                if frame is not None and now - self._last_display >= 1 / self.DISPLAY_RATE:
+                    self._last_display = now
+                    if self._merge_mask is not None:
+                        if np.any(self._merge_mask > 0):
+                            tm = cv2.cvtColor(self._merge_mask, cv2.COLOR_BGR2GRAY)
+                            _, tm = cv2.threshold(tm, 127, 255, cv2.THRESH_BINARY)
+                            _, mcontours, _ = cv2.findContours(tm, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+                            cv2.drawContours(frame, mcontours, -1, (0, 140, 255), thickness=3)
+
+                    self.display_frame_number(frame)
+                    if self._scale_factor is None:
+                        self._scale_factor = self._width / frame.shape[1]
+                        self.dsize = tuple(int(self._scale_factor * s) for s in frame.shape[:2])[::-1]
+                    frame = cv2.resize(frame, self.dsize,
+                                       dst=self.get_buffer('display', self.dsize[::-1] + frame.shape[2:]))
+                    cv2.bitwise_and(frame, self.get_display_mask(), dst=frame)
+                    cv2.imshow(self.MAIN_WINDOW, frame)
+                if now - self._last_plot >= 1 / self.PLOT_RATE:
+                    self._last_plot = now
+                    self.plot_area()
+
+                # fast-forwarding through skipped frames is only limited by decoding; paused, there is no hurry
+                wait_ms = 1 if self.skip and not self.pause else 5
+                if not self.process_key(cv2.waitKey(wait_ms) & 0xFF):
+                    break
+        finally:
+            self._reader.stop()
+            cap.release()
+            cv2.setNumThreads(num_threads)
         cv2.destroyAllWindows()
 
 
+def _track_manual_chunk(tracker, start, stop, warmup):
+    """ Tracks frames [start, stop) with a copy of a ManualTracker. Used by ManualTracker.run_headless. """
+    return tracker.track_frames(start, stop, warmup=warmup)
+
+
 if __name__ == "__main__":
     tracker = ManualTracker('video2.mp4')
     tracker.run()